@@ -0,0 +1,35 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import functools
+from typing import Optional, Tuple
+
+import google.auth
+from google.auth.credentials import Credentials
+
+_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+@functools.lru_cache(maxsize=1)
+def get_credentials() -> Tuple[Credentials, Optional[str]]:
+    """Resolve Application Default Credentials once per process.
+
+    The agent config, the deploy script and the Agent Engine client share the
+    result instead of running ADC discovery on their own.
+
+    Returns:
+        Tuple of (credentials, project_id) as returned by ``google.auth.default()``.
+    """
+    return google.auth.default(scopes=_SCOPES)
@@ -1,21 +1,93 @@
-from typing import Any, Dict, Optional
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from threading import RLock
+from typing import Any, Dict, List, Optional, Tuple
 
-import google.auth
+import sqlglot
+from cachetools import TTLCache, cached
 from google.adk.agents import Agent
 from google.adk.tools.base_tool import BaseTool
 from google.adk.tools.bigquery import BigQueryCredentialsConfig, BigQueryToolset
 from google.adk.tools.bigquery.config import BigQueryToolConfig, WriteMode
 from google.adk.tools.tool_context import ToolContext
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
 
 from .config import config
 
 # Agent Engineにデプロイするときにサービスアカウントでエージェントを動作させ
 # Tool自体の認証にも同じサービスアカウントを使ってほしい場合は以下をコメントアウト
-# application_default_credentials, _ = google.auth.default()
 # credentials_config = BigQueryCredentialsConfig(
-#     credentials=application_default_credentials
+#     credentials=config.credentials
 # )
 
+# 並行して実行されるドライラン（asyncio.to_thread のワーカー数）に合わせた接続プールのサイズ
+_HTTP_POOL_MAXSIZE = 32
+# google-cloud-core が自前でセッションを作るときと同じトークン更新のタイムアウト
+_CREDENTIALS_REFRESH_TIMEOUT = 300
+
+
+def _build_http_session() -> AuthorizedSession:
+    """Build the authorized HTTP session shared by all BigQuery calls of this agent.
+
+    Mirrors what ``google.cloud.client.Client`` does for its default session,
+    but mounts a larger connection pool first. ``configure_mtls_channel`` copies
+    the pool size onto the mutual TLS adapter when a client certificate is in
+    use, so the pool survives mTLS setup.
+    """
+    session = AuthorizedSession(
+        with_scopes_if_required(config.credentials, scopes=bigquery.Client.SCOPE),
+        refresh_timeout=_CREDENTIALS_REFRESH_TIMEOUT,
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=_HTTP_POOL_MAXSIZE))
+    session.configure_mtls_channel()
+    return session
+
+
+# ドライラン用の BigQuery クライアント（モジュール読み込み時に一度だけ生成し、接続を使い回す）
+_BQ_CLIENT = bigquery.Client(
+    credentials=config.credentials,
+    project=config.project_id,
+    _http=_build_http_session(),
+)
+
+# ドライラン結果のキャッシュ（同じクエリを再確認するときに BigQuery を再度呼ばない）
+_DRYRUN_CACHE = TTLCache(maxsize=1024, ttl=300)
+_DRYRUN_LOCK = RLock()
+
+# スキーマダイジェストのローカルキャッシュ（データセットの etag が変わったとき、または期限切れのときに再構築する）
+_SCHEMA_CACHE_PATH = Path(__file__).with_name(".schema_cache.json")
+# キャッシュの保存形式を変えたときは上げる
+_SCHEMA_CACHE_VERSION = 3
+# データセットの etag はテーブルの追加や説明の変更では変わらないため、一定時間で取り直す
+_SCHEMA_CACHE_TTL_SECONDS = 3600
+
+# メタデータ見積もりに使うテーブルサイズ（データ追加で変わるため、期限切れになったら 1 クエリで取り直す）
+_TABLE_SIZES_CACHE = TTLCache(maxsize=1, ttl=600)
+_TABLE_SIZES_LOCK = RLock()
+
+# 起動時のメタデータ取得が BigQuery に到達できない場合でも長時間ブロックしないよう、短い上限を設ける
+_METADATA_TIMEOUT = 10.0
+_METADATA_RETRY = bigquery.DEFAULT_RETRY.with_timeout(30.0)
+
+# 実行を禁止するステートメント
+_FORBIDDEN_STATEMENTS = {
+    exp.Delete: "DELETE",
+    exp.Drop: "DROP",
+    exp.TruncateTable: "TRUNCATE",
+    exp.Update: "UPDATE",
+    exp.Merge: "MERGE",
+}
+
 tool_config = BigQueryToolConfig(write_mode=WriteMode.BLOCKED)
 
 bigquery_toolset = BigQueryToolset(
@@ -25,6 +97,187 @@ bigquery_toolset = BigQueryToolset(
 )
 
 
+def _dry_run_cache_key(query: str, project_id: str) -> Tuple[str, str]:
+    # 空白の揺れだけを正規化する（識別子や文字列リテラルの大文字小文字は結果に影響しうるため保持）
+    normalized_query = " ".join(query.split())
+    return project_id, hashlib.sha256(normalized_query.encode("utf-8")).hexdigest()
+
+
+@cached(_DRYRUN_CACHE, key=_dry_run_cache_key, lock=_DRYRUN_LOCK)
+def _dry_run_bytes(query: str, project_id: str) -> int:
+    """Dry-run the query and return the number of bytes it would process.
+
+    Results are cached for a short TTL so that re-checking the same SQL
+    within a session does not issue another BigQuery API request.
+    """
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = _BQ_CLIENT.query(
+        query,
+        project=project_id,
+        job_config=job_config,
+    )  # Make an API request.
+    return query_job.total_bytes_processed
+
+
+def _load_schema_digest() -> List[Dict[str, Any]]:
+    """Return per-table metadata (name, description) of ``config.dataset_id``.
+
+    The digest is cached on disk keyed by (format version, project_id, dataset_id,
+    dataset etag), so per-table metadata is only fetched again when the dataset
+    has changed or the cache is older than ``_SCHEMA_CACHE_TTL_SECONDS``.
+    """
+    try:
+        dataset = _BQ_CLIENT.get_dataset(
+            f"{config.project_id}.{config.dataset_id}",
+            retry=_METADATA_RETRY,
+            timeout=_METADATA_TIMEOUT,
+        )
+        cache_key = [
+            _SCHEMA_CACHE_VERSION,
+            config.project_id,
+            config.dataset_id,
+            dataset.etag,
+        ]
+        try:
+            cached_digest = json.loads(_SCHEMA_CACHE_PATH.read_text(encoding="utf-8"))
+            fetched_at = cached_digest.get("fetched_at", 0.0)
+            if (
+                cached_digest.get("key") == cache_key
+                and time.time() - fetched_at < _SCHEMA_CACHE_TTL_SECONDS
+            ):
+                return cached_digest["tables"]
+        except (OSError, ValueError):
+            pass
+
+        fetched_at = time.time()
+        tables = []
+        for table_item in _BQ_CLIENT.list_tables(
+            dataset, retry=_METADATA_RETRY, timeout=_METADATA_TIMEOUT
+        ):
+            table = _BQ_CLIENT.get_table(
+                table_item.reference, retry=_METADATA_RETRY, timeout=_METADATA_TIMEOUT
+            )
+            tables.append(
+                {
+                    "name": table.table_id,
+                    "description": table.description or "",
+                }
+            )
+    except Exception as e:
+        logging.warning("Failed to load schema digest for %s: %s", config.dataset_id, e)
+        return []
+
+    try:
+        _SCHEMA_CACHE_PATH.write_text(
+            json.dumps(
+                {"key": cache_key, "fetched_at": fetched_at, "tables": tables},
+                ensure_ascii=False,
+            ),
+            encoding="utf-8",
+        )
+    except OSError as e:
+        logging.warning("Failed to write schema digest cache: %s", e)
+    return tables
+
+
+def _format_table_index(table_index: List[Tuple[str, str]]) -> str:
+    """Render the table index as a markdown list for the agent instruction."""
+    if not table_index:
+        return "（テーブル一覧を取得できませんでした。ツールを使ってメタデータを確認してください）"
+    return "\n".join(
+        f"- {name}: {description}" if description else f"- {name}"
+        for name, description in table_index
+    )
+
+
+# エージェント起動時にテーブル名と概要だけを指示文に埋め込み、
+# カラム定義は必要なテーブルについてのみ get_table_info で取得させる
+_SCHEMA_DIGEST = _load_schema_digest()
+_TABLE_INDEX = [
+    (table["name"], table["description"].strip().split("\n", 1)[0])
+    for table in _SCHEMA_DIGEST
+]
+# テーブル一覧を取得できなかったときは、一覧の取得を省略させる指示を出さない
+_TABLE_INDEX_GUIDANCE = (
+    "データセット内のテーブルは以下の通りです。テーブル一覧の取得は不要で、カラム定義が必要なテーブルについてのみ get_table_info を呼び出してください。"
+    if _TABLE_INDEX
+    else "list_table_ids でテーブル一覧を取得し、カラム定義が必要なテーブルについてのみ get_table_info を呼び出してください。"
+)
+
+
+
+def _load_table_sizes() -> Dict[str, int]:
+    """Return the size in bytes of each base table in ``config.dataset_id``.
+
+    Sizes are read with a single ``__TABLES__`` query and kept for the TTL of
+    ``_TABLE_SIZES_CACHE``. The lock is held while fetching so that concurrent
+    callers wait for one refresh instead of each issuing the query. On failure
+    an empty mapping is cached, which sends every query to the dry run.
+    """
+    with _TABLE_SIZES_LOCK:
+        table_sizes = _TABLE_SIZES_CACHE.get(config.dataset_id)
+        if table_sizes is not None:
+            return table_sizes
+        # ビュー（type = 2）や外部テーブル（type = 3）はサイズがスキャン量の上限にならないため、通常テーブルのみを対象とする
+        query = (
+            "SELECT table_id, size_bytes"
+            f" FROM `{config.project_id}.{config.dataset_id}.__TABLES__`"
+            " WHERE type = 1"
+        )
+        try:
+            rows = _BQ_CLIENT.query_and_wait(
+                query, project=config.project_id, api_timeout=_METADATA_TIMEOUT
+            )
+            table_sizes = {row["table_id"]: row["size_bytes"] for row in rows}
+        except Exception as e:
+            logging.warning("Failed to load table sizes for %s: %s", config.dataset_id, e)
+            table_sizes = {}
+        _TABLE_SIZES_CACHE[config.dataset_id] = table_sizes
+        return table_sizes
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_sql(query: str) -> Tuple[exp.Expression, ...]:
+    """Parse a BigQuery SQL script into one syntax tree per statement.
+
+    Trees are cached and shared between callers, so they must not be mutated.
+    """
+    return tuple(
+        tree for tree in sqlglot.parse(query, dialect="bigquery") if tree is not None
+    )
+
+
+def _estimate_bytes_from_metadata(
+    trees: Tuple[exp.Expression, ...], project_id: str, table_sizes: Dict[str, int]
+) -> Optional[int]:
+    """Upper-bound the bytes scanned by the query from the given table sizes.
+
+    Returns None when there are no parsed statements, when any statement is not
+    a plain query, or when the query references any table whose size is not in
+    ``table_sizes``; in those cases a dry run is required.
+    """
+    if not trees:
+        return None
+    total_bytes = 0
+    for tree in trees:
+        # Command（スクリプトや EXECUTE IMMEDIATE）や DML/DDL は参照テーブルを静的に把握できない
+        if not isinstance(tree, exp.Query):
+            return None
+        cte_names = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+        for table in tree.find_all(exp.Table):
+            if not table.db and table.name in cte_names:
+                continue
+            # プロジェクト未指定のテーブルはクエリの実行プロジェクト（args の project_id）で解決される
+            catalog = table.catalog or project_id
+            if table.db != config.dataset_id or catalog != config.project_id:
+                return None
+            table_bytes = table_sizes.get(table.name)
+            if table_bytes is None:
+                return None
+            total_bytes += table_bytes
+    return total_bytes
+
+
 async def update_bigquery_api_count(
     tool: BaseTool, args: Dict[str, Any], tool_context: ToolContext, tool_response: Dict
 ) -> None:
@@ -35,51 +288,65 @@ async def update_bigquery_api_count(
     return None
 
 
-def validate_sql_callback(
+async def precheck_sql_callback(
     tool: BaseTool, args: Dict[str, Any], tool_context: ToolContext
 ) -> Optional[Dict]:
-    if tool.name == "execute_sql":
-        if "delete" in args.get("query", "").lower():
-            return {
-                "result": "Tool execution was blocked due to forbidden delete statement!"
-            }
-    print("@before_tool_callback: No blocking required")
-    return None
+    if tool.name != "execute_sql":
+        logging.debug("@precheck_sql_callback: No precheck required")
+        return None
 
+    query = args.get("query", "")
+    project_id = args.get("project_id")
 
-def sql_query_dryrun_callback(
-    tool: BaseTool, args: Dict[str, Any], tool_context: ToolContext
-) -> Optional[Dict]:
-    if tool.name == "execute_sql" and "query" in args and "project_id" in args:
-        query = args.get("query")
-        project_id = args.get("project_id")
-        from google.cloud import bigquery
-
-        # Construct a BigQuery client object.
-        client = bigquery.Client()
-
-        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-
-        # Start the query, passing in the extra configuration.
-        query_job = client.query(
-            query,
-            project=project_id,
-            job_config=job_config,
-        )  # Make an API request.
-
-        total_bytes_processed = query_job.total_bytes_processed
-
-        # A dry run query completes immediately.
-        print("This query will process {} bytes.".format(total_bytes_processed))
-        if total_bytes_processed > config.dry_run_threshold_bytes:
-            threshold_gb = config.dry_run_threshold_bytes / 1_000_000_000
-            return {
-                "result": f"Large size SQL query is forbidden. The query size by dry run is {total_bytes_processed} bytes > {threshold_gb} GB"
-            }
-        else:
-            print("@sql_query_dryrun_callback: SQL query dry run successful")
-            return None
-    print("@sql_query_dryrun_callback: No dry run required")
+    # SQL を一度だけパースし、禁止ステートメントを含む場合はブロックする
+    try:
+        trees = _parse_sql(query)
+    except SqlglotError as e:
+        # sqlglot が未対応の関数（APPENDS など）を含む正しい読み取りクエリもあるため、ここではブロックしない。
+        # 書き込みは BigQueryToolset の WriteMode.BLOCKED が拒否し、スキャン量は下のドライランで確認する
+        errors = getattr(e, "errors", None)
+        logging.debug(
+            "@precheck_sql_callback: SQL could not be parsed locally: %s",
+            errors[0]["description"] if errors else type(e).__name__,
+        )
+        trees = ()
+    for tree in trees:
+        for node in tree.walk():
+            # sqlglot が解釈できない構文（BEGIN ... END, EXECUTE IMMEDIATE, CALL など）は
+            # Command として中身を検査できないため、同様にブロックする
+            if isinstance(node, exp.Command):
+                return {
+                    "result": "Tool execution was blocked because the SQL statement could not be fully parsed (scripts, EXECUTE IMMEDIATE and CALL are not allowed)."
+                }
+            statement = _FORBIDDEN_STATEMENTS.get(type(node))
+            if statement:
+                return {
+                    "result": f"Tool execution was blocked due to forbidden {statement} statement!"
+                }
+
+    if not query or not project_id:
+        logging.debug("@precheck_sql_callback: No dry run required")
+        return None
+
+    # 参照テーブルの合計サイズが閾値の 1/10 未満なら、ドライランを省略する
+    table_sizes = await asyncio.to_thread(_load_table_sizes)
+    estimated_bytes = _estimate_bytes_from_metadata(trees, project_id, table_sizes)
+    if estimated_bytes is not None and estimated_bytes < config.dry_run_threshold_bytes / 10:
+        logging.debug(
+            "@precheck_sql_callback: Dry run skipped for small tables (%d bytes)", estimated_bytes
+        )
+        return None
+
+    total_bytes_processed = await asyncio.to_thread(_dry_run_bytes, query, project_id)
+
+    # A dry run query completes immediately.
+    logging.debug("This query will process %s bytes.", total_bytes_processed)
+    if total_bytes_processed > config.dry_run_threshold_bytes:
+        threshold_gb = config.dry_run_threshold_bytes / 1_000_000_000
+        return {
+            "result": f"Large size SQL query is forbidden. The query size by dry run is {total_bytes_processed} bytes > {threshold_gb} GB"
+        }
+    logging.debug("@precheck_sql_callback: SQL query dry run successful")
     return None
 
 
@@ -92,9 +359,11 @@ root_agent = Agent(
     適切なツールを用いて BigQuery のメタデータを取得したり SQL クエリを実行し、ユーザーの質問に日本語で回答してください。
     すべてのクエリは project-id: {config.project_id} 上で実行してください。
     テーブルはデータセット: {config.dataset_id}に存在します。
+    {_TABLE_INDEX_GUIDANCE}
+{_format_table_index(_TABLE_INDEX)}
     Callback の結果からクエリの実行が禁止されている場合は、その理由をユーザーに報告し、このタスクを終了してください。
 """,
     tools=[bigquery_toolset],
     after_tool_callback=update_bigquery_api_count,
-    before_tool_callback=[validate_sql_callback, sql_query_dryrun_callback],
+    before_tool_callback=[precheck_sql_callback],
 )
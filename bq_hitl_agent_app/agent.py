@@ -12,24 +12,106 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import hashlib
+import json
 import logging
-from typing import Any, Dict
-
-import google.auth
+import re
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import RLock
+from typing import Any, Dict, List, Optional, Tuple
+
+from cachetools import TTLCache, cached
 from google.adk.agents import LlmAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
 from google.adk.tools import FunctionTool
 from google.adk.tools.agent_tool import AgentTool
+from google.adk.tools.base_tool import BaseTool
 from google.adk.tools.bigquery import BigQueryCredentialsConfig, BigQueryToolset
 from google.adk.tools.bigquery.config import BigQueryToolConfig, WriteMode
 from google.adk.tools.tool_context import ToolContext
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from google.genai import types
+from requests.adapters import HTTPAdapter
 
 from .config import config
 
-application_default_credentials, _ = google.auth.default()
-credentials_config = BigQueryCredentialsConfig(
-    credentials=application_default_credentials
+credentials_config = BigQueryCredentialsConfig(credentials=config.credentials)
+
+# 並行して実行されるドライラン（asyncio.to_thread のワーカー数）に合わせた接続プールのサイズ
+_HTTP_POOL_MAXSIZE = 32
+# google-cloud-core が自前でセッションを作るときと同じトークン更新のタイムアウト
+_CREDENTIALS_REFRESH_TIMEOUT = 300
+
+
+def _build_http_session() -> AuthorizedSession:
+    """Build the authorized HTTP session shared by all BigQuery calls of this agent.
+
+    Mirrors what ``google.cloud.client.Client`` does for its default session,
+    but mounts a larger connection pool first. ``configure_mtls_channel`` copies
+    the pool size onto the mutual TLS adapter when a client certificate is in
+    use, so the pool survives mTLS setup.
+    """
+    session = AuthorizedSession(
+        with_scopes_if_required(config.credentials, scopes=bigquery.Client.SCOPE),
+        refresh_timeout=_CREDENTIALS_REFRESH_TIMEOUT,
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=_HTTP_POOL_MAXSIZE))
+    session.configure_mtls_channel()
+    return session
+
+
+# ドライラン用の BigQuery クライアント（モジュール読み込み時に一度だけ生成し、接続を使い回す）
+_BQ_CLIENT = bigquery.Client(
+    credentials=config.credentials,
+    project=config.project_id,
+    _http=_build_http_session(),
+)
+
+# ドライラン結果のキャッシュ（同じクエリを再確認するときに BigQuery を再度呼ばない）
+_DRYRUN_CACHE = TTLCache(maxsize=1024, ttl=300)
+_DRYRUN_LOCK = RLock()
+
+# スキーマダイジェストのローカルキャッシュ（データセットの etag が変わったとき、または期限切れのときに再構築する）
+_SCHEMA_CACHE_PATH = Path(__file__).with_name(".schema_cache.json")
+# キャッシュの保存形式を変えたときは上げる
+_SCHEMA_CACHE_VERSION = 3
+# データセットの etag はテーブルの追加や説明の変更では変わらないため、一定時間で取り直す
+_SCHEMA_CACHE_TTL_SECONDS = 3600
+
+# 起動時のメタデータ取得が BigQuery に到達できない場合でも長時間ブロックしないよう、短い上限を設ける
+_METADATA_TIMEOUT = 10.0
+_METADATA_RETRY = bigquery.DEFAULT_RETRY.with_timeout(30.0)
+
+# 承認キーワードのみからなるユーザーメッセージ（「実行しないで」などを承認と誤判定しないよう全体一致で判定する）
+_APPROVAL_RE = re.compile(
+    r"\s*(承認(します)?|実行(してください)?|OK|了解|はい)[\s。．.!！]*", re.IGNORECASE
 )
 
+
+@dataclass(slots=True)
+class PendingQuery:
+    """A query awaiting user approval, stored under the ``pending_query`` state key.
+
+    Attributes:
+        query (str): SQL query string awaiting approval.
+        total_bytes_processed (int): Number of bytes the query would scan.
+        project_id (str): Google Cloud project ID to run the query in.
+        invocation_id (Optional[str]): Root agent invocation (turn) that asked
+            the user for approval; set once the planner tool returns.
+    """
+
+    query: str
+    total_bytes_processed: int
+    project_id: str
+    invocation_id: Optional[str] = None
+
+
 tool_config = BigQueryToolConfig(write_mode=WriteMode.BLOCKED)
 
 # BigQuery Toolset
@@ -40,6 +122,114 @@ bigquery_toolset = BigQueryToolset(
 )
 
 
+def _dry_run_cache_key(query: str, project_id: str) -> Tuple[str, str]:
+    # 空白の揺れだけを正規化する（識別子や文字列リテラルの大文字小文字は結果に影響しうるため保持）
+    normalized_query = " ".join(query.split())
+    return project_id, hashlib.sha256(normalized_query.encode("utf-8")).hexdigest()
+
+
+@cached(_DRYRUN_CACHE, key=_dry_run_cache_key, lock=_DRYRUN_LOCK)
+def _dry_run_bytes(query: str, project_id: str) -> int:
+    """Dry-run the query and return the number of bytes it would process.
+
+    Results are cached for a short TTL so that re-checking the same SQL
+    within a session does not issue another BigQuery API request.
+    """
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = _BQ_CLIENT.query(
+        query,
+        project=project_id,
+        job_config=job_config,
+    )  # Make an API request.
+    return query_job.total_bytes_processed
+
+
+def _load_schema_digest() -> List[Dict[str, Any]]:
+    """Return per-table metadata (name, description) of ``config.dataset_id``.
+
+    The digest is cached on disk keyed by (format version, project_id, dataset_id,
+    dataset etag), so per-table metadata is only fetched again when the dataset
+    has changed or the cache is older than ``_SCHEMA_CACHE_TTL_SECONDS``.
+    """
+    try:
+        dataset = _BQ_CLIENT.get_dataset(
+            f"{config.project_id}.{config.dataset_id}",
+            retry=_METADATA_RETRY,
+            timeout=_METADATA_TIMEOUT,
+        )
+        cache_key = [
+            _SCHEMA_CACHE_VERSION,
+            config.project_id,
+            config.dataset_id,
+            dataset.etag,
+        ]
+        try:
+            cached_digest = json.loads(_SCHEMA_CACHE_PATH.read_text(encoding="utf-8"))
+            fetched_at = cached_digest.get("fetched_at", 0.0)
+            if (
+                cached_digest.get("key") == cache_key
+                and time.time() - fetched_at < _SCHEMA_CACHE_TTL_SECONDS
+            ):
+                return cached_digest["tables"]
+        except (OSError, ValueError):
+            pass
+
+        fetched_at = time.time()
+        tables = []
+        for table_item in _BQ_CLIENT.list_tables(
+            dataset, retry=_METADATA_RETRY, timeout=_METADATA_TIMEOUT
+        ):
+            table = _BQ_CLIENT.get_table(
+                table_item.reference, retry=_METADATA_RETRY, timeout=_METADATA_TIMEOUT
+            )
+            tables.append(
+                {
+                    "name": table.table_id,
+                    "description": table.description or "",
+                }
+            )
+    except Exception as e:
+        logging.warning("Failed to load schema digest for %s: %s", config.dataset_id, e)
+        return []
+
+    try:
+        _SCHEMA_CACHE_PATH.write_text(
+            json.dumps(
+                {"key": cache_key, "fetched_at": fetched_at, "tables": tables},
+                ensure_ascii=False,
+            ),
+            encoding="utf-8",
+        )
+    except OSError as e:
+        logging.warning("Failed to write schema digest cache: %s", e)
+    return tables
+
+
+def _format_table_index(table_index: List[Tuple[str, str]]) -> str:
+    """Render the table index as a markdown list for the agent instruction."""
+    if not table_index:
+        return "（テーブル一覧を取得できませんでした。ツールを使ってメタデータを確認してください）"
+    return "\n".join(
+        f"- {name}: {description}" if description else f"- {name}"
+        for name, description in table_index
+    )
+
+
+# エージェント起動時にテーブル名と概要だけを指示文に埋め込み、
+# カラム定義は必要なテーブルについてのみ get_table_info で取得させる
+_SCHEMA_DIGEST = _load_schema_digest()
+_TABLE_INDEX = [
+    (table["name"], table["description"].strip().split("\n", 1)[0])
+    for table in _SCHEMA_DIGEST
+]
+# テーブル一覧を取得できなかったときは、一覧から選ぶ代わりにツールでテーブルを探させる
+_TABLE_SELECTION_STEP = (
+    "下記のテーブル一覧から必要なテーブルを選び、そのテーブルについてのみ`get_table_info`でスキーマを取得します。"
+    if _TABLE_INDEX
+    else "`list_table_ids`でテーブル一覧を取得し、必要なテーブルについてのみ`get_table_info`でスキーマを取得します。"
+)
+
+
 async def check_query_cost(
     tool_context: ToolContext, query: str, project_id: str
 ) -> Dict[str, Any]:
@@ -56,32 +246,28 @@ async def check_query_cost(
         - total_bytes_processed: Number of bytes that would be scanned
         - message: Human-readable message about the scan cost
     """
+    # 直前のチェック結果だけを承認待ちとして残すため、承認不要・エラーのときは保留中のクエリを消す
     if not query or not project_id:
+        tool_context.state["pending_query"] = None
         return {
             "status": "ERROR",
             "message": "Query or Project ID is missing",
         }
 
     try:
-        from google.cloud import bigquery
-
-        # BigQueryクライアントの初期化とドライラン実行
-        client = bigquery.Client()
-        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-        query_job = client.query(
-            query,
-            project=project_id,
-            job_config=job_config,
+        # ドライラン実行（同じクエリの結果はキャッシュから返す）
+        # 同期クライアントの API 呼び出しでイベントループを止めないよう別スレッドで実行する
+        total_bytes_processed = await asyncio.to_thread(
+            _dry_run_bytes, query, project_id
         )
 
-        total_bytes_processed = query_job.total_bytes_processed
-
         # 承認が必要な閾値を超えているかチェック
         if total_bytes_processed >= config.approval_threshold_bytes:
             # スキャン量とクエリをセッションステートに保存
-            tool_context.state["pending_query"] = query
-            tool_context.state["pending_query_bytes"] = total_bytes_processed
-            tool_context.state["pending_query_project_id"] = project_id
+            # （ステートは JSON で永続化されるため、dict に変換して 1 キーにまとめて書き込む）
+            tool_context.state["pending_query"] = asdict(
+                PendingQuery(query, total_bytes_processed, project_id)
+            )
 
             bytes_gb = total_bytes_processed / 1_000_000_000
             return {
@@ -90,6 +276,7 @@ async def check_query_cost(
                 "message": f"このクエリは約 {bytes_gb:.2f} GB ({total_bytes_processed:,} bytes) のデータをスキャンします。実行するには承認が必要です。",
             }
         else:
+            tool_context.state["pending_query"] = None
             bytes_mb = total_bytes_processed / 1_000_000
             return {
                 "status": "APPROVED",
@@ -98,7 +285,8 @@ async def check_query_cost(
             }
 
     except Exception as e:
-        logging.error(f"Error during query dry-run: {e}")
+        logging.error("Error during query dry-run: %s", e)
+        tool_context.state["pending_query"] = None
         return {
             "status": "ERROR",
             "message": f"クエリのドライラン中にエラーが発生しました: {str(e)}",
@@ -109,15 +297,11 @@ check_query_cost_tool = FunctionTool(func=check_query_cost)
 
 
 # --- Query Plan Generator Agent ---
-query_plan_generator = LlmAgent(
-    model=config.worker_model,
-    name="query_plan_generator",
-    description="ユーザーの質問に基づいてBigQueryのメタデータを使用してSQLクエリプランを生成します。",
-    instruction=f"""
+_QUERY_PLAN_GENERATOR_INSTRUCTION = f"""
     あなたはBigQueryのSQLクエリプランナーです。ユーザーの質問に基づいてSQLクエリプランを作成するのがあなたの仕事です。
 
     **ワークフロー:**
-    1. BigQueryツールセットを使用して、データセット内の利用可能なテーブルとスキーマを探索します。
+    1. {_TABLE_SELECTION_STEP}
     2. ユーザーの質問に答える適切なSQLクエリを生成します。
     3. クエリを生成した後、必ず`check_query_cost`ツールを呼び出してスキャンコストを確認します。
     4. クエリとコスト情報をユーザーに提示します。
@@ -136,18 +320,23 @@ query_plan_generator = LlmAgent(
     - 推定スキャンコスト
     - 承認が必要かどうか
     - 承認が必要な場合の明確な承認リクエスト（例：「このクエリを実行するには承認が必要です。承認する場合は「承認します」または「実行してください」とお答えください。」）
-    """,
+
+    **データセットのテーブル一覧:**
+{_format_table_index(_TABLE_INDEX)}
+    """
+
+query_plan_generator = LlmAgent(
+    model=config.worker_model,
+    name="query_plan_generator",
+    description="ユーザーの質問に基づいてBigQueryのメタデータを使用してSQLクエリプランを生成します。",
+    instruction=_QUERY_PLAN_GENERATOR_INSTRUCTION,
     tools=[bigquery_toolset, check_query_cost_tool],
     output_key="query_plan",
 )
 
 
 # --- Query Executor Agent ---
-query_executor_agent = LlmAgent(
-    model=config.worker_model,
-    name="query_executor",
-    description="承認されたBigQuery SQLクエリを実行し、結果を分析します。",
-    instruction=f"""
+_QUERY_EXECUTOR_INSTRUCTION = f"""
     あなたはBigQueryクエリ実行者兼データアナリストです。承認されたSQLクエリを実行し、ユーザーに洞察を提供するのがあなたの仕事です。
 
     **ワークフロー:**
@@ -166,17 +355,93 @@ query_executor_agent = LlmAgent(
     - クエリ結果に基づいてユーザーの質問に対する明確な回答を提供します。
     - 関連するデータポイントと洞察を含めます。
     - 結果を読みやすい形式（テーブル、要約など）でフォーマットします。
-    """,
+    """
+
+query_executor_agent = LlmAgent(
+    model=config.worker_model,
+    name="query_executor",
+    description="承認されたBigQuery SQLクエリを実行し、結果を分析します。",
+    instruction=_QUERY_EXECUTOR_INSTRUCTION,
     tools=[bigquery_toolset],
 )
 
 
 # --- Root Agent (HITL) ---
-root_agent = LlmAgent(
-    name="BigQueryHITLWorkflow",
-    model=config.worker_model,
-    description="主要なBigQueryアシスタント。実行前にユーザーと協力してクエリプランを作成し、承認を得ます。",
-    instruction=f"""
+def stamp_pending_query_callback(
+    tool: BaseTool, args: Dict[str, Any], tool_context: ToolContext, tool_response: Dict
+) -> None:
+    """Record which root invocation produced the query now awaiting approval.
+
+    ``check_query_cost`` runs inside the AgentTool's own runner, so its
+    invocation id is not the root agent's; the root turn is stamped here once
+    the planner tool returns.
+    """
+    if tool.name != query_plan_generator.name:
+        return None
+    pending_state = tool_context.state.get("pending_query")
+    if isinstance(pending_state, dict) and not pending_state.get("invocation_id"):
+        tool_context.state["pending_query"] = {
+            **pending_state,
+            "invocation_id": tool_context.invocation_id,
+        }
+    return None
+
+
+def _previous_invocation_id(callback_context: CallbackContext) -> Optional[str]:
+    """Return the invocation id of the turn before the current one, if any."""
+    for event in reversed(callback_context.session.events):
+        if event.invocation_id != callback_context.invocation_id:
+            return event.invocation_id
+    return None
+
+
+def approve_pending_query_callback(
+    callback_context: CallbackContext, llm_request: LlmRequest
+) -> Optional[LlmResponse]:
+    """Route an explicit approval of the pending query straight to query_executor.
+
+    When a query from the previous turn is awaiting approval and the user
+    message consists only of an approval keyword, the planner LLM call is
+    skipped and a `query_executor` function call is returned directly.
+    """
+    pending_state = callback_context.state.get("pending_query")
+    user_content = callback_context.user_content
+    # 以前の形式（SQL 文字列のみ）で保存されたセッションは、保留中のクエリなしとして扱う
+    if not isinstance(pending_state, dict) or not user_content or not user_content.parts:
+        return None
+    user_message = "".join(part.text or "" for part in user_content.parts)
+    if not _APPROVAL_RE.fullmatch(user_message):
+        return None
+
+    pending_query = PendingQuery(**pending_state)
+    # 承認を求めた直後のターンの返答でなければ、どのクエリへの承認か分からないためプランナーに任せる
+    if pending_query.invocation_id != _previous_invocation_id(callback_context):
+        return None
+    callback_context.state["approved_query"] = pending_query.query
+    callback_context.state["approved_query_project_id"] = pending_query.project_id
+    callback_context.state["pending_query"] = None
+    request = (
+        "ユーザーが承認した以下のクエリを実行してください。\n"
+        f"project_id: {pending_query.project_id}\n"
+        f"query:\n{pending_query.query}"
+    )
+    return LlmResponse(
+        content=types.Content(
+            role="model",
+            parts=[
+                types.Part(
+                    function_call=types.FunctionCall(
+                        name=query_executor_agent.name, args={"request": request}
+                    )
+                )
+            ],
+        )
+    )
+
+
+_APPROVAL_THRESHOLD_GB = config.approval_threshold_bytes / 1_000_000_000
+
+_PLANNER_INSTRUCTION = f"""
     あなたはBigQueryクエリ計画アシスタントです。あなたの主な機能は、ユーザーの要求を承認されたSQLクエリプランに変換することです。
 
     **重要なルール: 高コストのクエリについては、ユーザーの承認なしに直接クエリを実行しないでください。**
@@ -185,7 +450,7 @@ root_agent = LlmAgent(
     1. **計画:** `query_plan_generator`ツールを使用して、ユーザーの質問に基づいてSQLクエリプランを作成します。
     2. **提示:** 生成されたクエリとその推定スキャンコストをユーザーに表示します。
     3. **承認待ち:** 
-       - 承認が必要な場合（スキャンコスト >= {config.approval_threshold_bytes / 1_000_000_000} GB）、ユーザーに明示的に承認を求めます。
+       - 承認が必要な場合（スキャンコスト >= {_APPROVAL_THRESHOLD_GB} GB）、ユーザーに明示的に承認を求めます。
        - クエリをセッションステートに`pending_query`として保存します。
        - ユーザーの明示的な確認を待ちます（例：「承認します」「実行してください」「OK」「承認」「了解」「はい」）。
     4. **実行:** ユーザーが明示的に承認した場合、または承認が不要な場合：
@@ -197,17 +462,25 @@ root_agent = LlmAgent(
     - ユーザーメッセージ内の承認キーワードを探します：「承認」「承認します」「実行」「実行してください」「OK」「了解」「はい」
     - ユーザーから明確な承認を受けるまで実行に進まないでください。
     - ユーザーが拒否したり、クエリの変更を求めたりした場合、`query_plan_generator`を再度使用してプランを改善します。
-    - 承認されたら、`approved_query` = `pending_query`を設定し、`query_executor`ツールを呼び出します。
+    - 承認されたら、`approved_query` = `pending_query`の`query`を設定し、`query_executor`ツールを呼び出します。
 
     **セッション状態の管理:**
-    - 保留中のクエリ: `pending_query`, `pending_query_bytes`, `pending_query_project_id`
+    - 保留中のクエリ: `pending_query`（`query`, `total_bytes_processed`, `project_id`を持つ）
     - 承認されたクエリ: `approved_query`, `approved_query_project_id`
     - 実行エージェントに委譲する際は、承認されたクエリの値を使用します。
 
     現在のプロジェクト: {config.project_id}
     現在のデータセット: {config.dataset_id}
-    """,
+    """
+
+root_agent = LlmAgent(
+    name="BigQueryHITLWorkflow",
+    model=config.worker_model,
+    description="主要なBigQueryアシスタント。実行前にユーザーと協力してクエリプランを作成し、承認を得ます。",
+    instruction=_PLANNER_INSTRUCTION,
     tools=[AgentTool(query_plan_generator), AgentTool(query_executor_agent)],
+    before_model_callback=approve_pending_query_callback,
+    after_tool_callback=stamp_pending_query_callback,
     output_key="query_plan",
 )
 
@@ -13,22 +13,30 @@
 # limitations under the License.
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import google.auth
+from google.auth.credentials import Credentials
 
 # To use AI Studio credentials:
 # 1. Create a .env file in the /app directory with:
 #    GOOGLE_GENAI_USE_VERTEXAI=FALSE
 #    GOOGLE_API_KEY=PASTE_YOUR_ACTUAL_API_KEY_HERE
 # 2. This will override the default Vertex AI configuration
-_, project_id = google.auth.default()
-os.environ.setdefault("GOOGLE_CLOUD_PROJECT", project_id)
-os.environ.setdefault("GOOGLE_CLOUD_LOCATION", "global")
-os.environ.setdefault("GOOGLE_GENAI_USE_VERTEXAI", "True")
+_CREDENTIALS, _PROJECT_ID = google.auth.default()
 
 
-@dataclass
+def _bootstrap_env() -> None:
+    """Set default environment variables for the Gen AI SDK (runs once at import)."""
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", _PROJECT_ID)
+    os.environ.setdefault("GOOGLE_CLOUD_LOCATION", "global")
+    os.environ.setdefault("GOOGLE_GENAI_USE_VERTEXAI", "True")
+
+
+_bootstrap_env()
+
+
+@dataclass(frozen=True, slots=True)
 class BigQueryHITLConfiguration:
     """Configuration for BigQuery HITL agent.
 
@@ -37,12 +45,14 @@ class BigQueryHITLConfiguration:
         project_id (str): Google Cloud project ID for BigQuery.
         dataset_id (str): BigQuery dataset ID.
         approval_threshold_bytes (int): Byte threshold for requiring user approval (default: 1GB).
+        credentials (Credentials): Application Default Credentials resolved once at import.
     """
 
     worker_model: str = "gemini-2.5-flash"
     project_id: str = "your-project-id"
     dataset_id: str = "your-dataset-id"
     approval_threshold_bytes: int = 1_000_000_000  # 1GB
+    credentials: Credentials = field(default=_CREDENTIALS, repr=False, compare=False)
 
 
 config = BigQueryHITLConfiguration()
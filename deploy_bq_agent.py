@@ -2,18 +2,32 @@ import asyncio
 import vertexai
 from bq_agent_app.agent import root_agent # modify this if your agent is not in agent.py
 from vertexai import agent_engines
+from bq_agent_app._auth import get_credentials
 from bq_agent_app.config import config
 
 PROJECT_ID = config.project_id
 LOCATION = "us-central1"
 STAGING_BUCKET = f"gs://{PROJECT_ID}-staging"
 SERVICE_ACCOUNT = f"bq-agent-sample@{PROJECT_ID}.iam.gserviceaccount.com"
+CREDENTIALS, _ = get_credentials()
+
+# Dependencies installed on Agent Engine (single source of truth for deploy variants)
+_REQUIREMENTS = (
+    "google-adk==1.19.0",
+    "google-cloud-aiplatform[adk,agent_engines]==1.128.0",
+    "pydantic==2.12.4",
+    "cloudpickle==3.1.2",
+    "cachetools==6.2.2",
+    "sqlglot==28.0.0",
+)
+_EXTRA_PACKAGES = ("bq_agent_app",)
 
 # Initialize the Vertex AI SDK
 vertexai.init(
     project=PROJECT_ID,
     location=LOCATION,
     staging_bucket=STAGING_BUCKET,
+    credentials=CREDENTIALS,
 )
 
 # Wrap the agent in an AdkApp object
@@ -26,45 +40,40 @@ def deploy_agent():
     remote_app = agent_engines.create(
         agent_engine=app,
         display_name=root_agent.name,
-        requirements=[
-            "google-adk==1.19.0",
-            "google-cloud-aiplatform[adk,agent_engines]==1.128.0",
-            'pydantic==2.12.4',
-            'cloudpickle==3.1.2',
-        ],
-        extra_packages=["bq_agent_app"],
+        requirements=list(_REQUIREMENTS),
+        extra_packages=list(_EXTRA_PACKAGES),
         service_account=SERVICE_ACCOUNT,
     )
 
     print("Deployment finished!")
     print(f"Resource Name: {remote_app.resource_name}")
 
-async def test_run():
-# Create a local session to maintain conversation history
-    session = await app.async_create_session(user_id="u_123")
-    print(session)
-    events = []
-    async for event in app.async_stream_query(
-        user_id="u_123",
-        session_id=session.id,
-        message="BigQueryのテーブル一覧を教えてください",
-    ):
-        events.append(event)
+async def test_run(n_sessions: int = 1):
+    async def _one_session(i: int):
+        # Create a local session to maintain conversation history
+        session = await app.async_create_session(user_id="u_123")
+        print(session)
+
+        # The full event stream shows the agent's thought process
+        print(f"--- Full Event Stream (session {i}) ---")
+        last_text = None
+        async for event in app.async_stream_query(
+            user_id="u_123",
+            session_id=session.id,
+            message="BigQueryのテーブル一覧を教えてください",
+        ):
+            print(f"[session {i}]", event)
+            # For quick tests, keep just the latest text response
+            part = ((event.get("content") or {}).get("parts") or [{}])[0]
+            if part.get("text") and not part.get("function_call"):
+                last_text = part["text"]
 
-    # The full event stream shows the agent's thought process
-    print("--- Full Event Stream ---")
-    for event in events:
-        print(event)
+        if last_text:
+            print(f"\n--- Final Response (session {i}) ---")
+            print(last_text)
 
-    # For quick tests, you can extract just the final text response
-    final_text_responses = [
-        e for e in events
-        if e.get("content", {}).get("parts", [{}])[0].get("text")
-        and not e.get("content", {}).get("parts", [{}])[0].get("function_call")
-    ]
-    if final_text_responses:
-        print("\n--- Final Response ---")
-        print(final_text_responses[0]["content"]["parts"][0]["text"])
+    # Run the sessions concurrently to emulate multiple users
+    await asyncio.gather(*(_one_session(i) for i in range(n_sessions)))
 
 
 if __name__ == "__main__":
@@ -1,28 +1,34 @@
 import asyncio
 import vertexai
 
+from bq_agent_app._auth import get_credentials
 from bq_agent_app.config import config
 
 PROJECT_ID = config.project_id
 LOCATION = "us-central1"
+CREDENTIALS, _ = get_credentials()
 
-async def main():
+async def main(n_sessions: int = 1):
     client = vertexai.Client(
         project=PROJECT_ID,
         location=LOCATION,
+        credentials=CREDENTIALS,
     )
 
     remote_app = client.agent_engines.get(name=f"projects/{PROJECT_ID}/locations/{LOCATION}/reasoningEngines/xxxxxxxxxx")
 
+    async def _one_session(i: int):
+        session = await remote_app.async_create_session(user_id="u_456")
 
-    session = await remote_app.async_create_session(user_id="u_456")
+        async for event in remote_app.async_stream_query(
+            user_id="u_456",
+            session_id=session["id"],
+            message="wikidata テーブルで日本の記事が何本あるか確認してください。",
+        ):
+            print(f"[session {i}]", event)
 
-    async for event in remote_app.async_stream_query(
-        user_id="u_456",
-        session_id=session["id"],
-        message="wikidata テーブルで日本の記事が何本あるか確認してください。",
-    ):
-        print(event)
+    # Run the sessions concurrently to emulate multiple users
+    await asyncio.gather(*(_one_session(i) for i in range(n_sessions)))
 
 
 if __name__ == "__main__":